@@ -37,6 +37,7 @@ options:
     uuid:
         description:
             - The unique image identifier or a docker-repo:tag.
+            - A list of identifiers manages several images in one run.
             - The common used C(name) is not used to avoid confusion with
               the name of the image - which is far from being unique.
         required: True
@@ -59,6 +60,12 @@ options:
         required: false
         default: false
         choices: ["true", "false"]
+    concurrency:
+        description:
+            - Number of images imported in parallel if several C(uuid)s are
+              given with C(state=present).
+        required: false
+        default: 3
 '''
 
 EXAMPLES = '''
@@ -73,12 +80,18 @@ smartos_image: uuid=d183f500-9a96-11e6-8976-ff3967dc023a zpool=newpool
 
 # Delete 'debian-8' image
 smartos_image: uuid=d183f500-9a96-11e6-8976-ff3967dc023a state=absent
+
+# Import 'debian-8' and 'base-64-lts' images
+smartos_image:
+  uuid:
+    - d183f500-9a96-11e6-8976-ff3967dc023a
+    - 390639d4-f146-11e7-9280-37ae5c6d53d4
 '''
 
 RETURN = '''
 uuid:
     description: Image idenifier.
-    returned: always
+    returned: If a single image is managed.
     type: string
     sample: "d183f500-9a96-11e6-8976-ff3967dc023a"
 state:
@@ -96,186 +109,339 @@ manifest:
     returnd: If image is present.
     type: json
     sample: "{ name: ..., description: ..., ... }"
+results:
+    description: Per image results with the keys above. Failed images
+                 also have C(failed), C(msg) and C(rc) set.
+    returned: always
+    type: list
+    sample: "[{ uuid: ..., changed: ..., manifest: ..., ... }]"
 '''
 
+import os
 import re
 import json
+import subprocess
+import tempfile
+import time
+
+from ansible.module_utils.basic import AnsibleModule
+from ansible.module_utils._text import to_native
 
 
 class IMAGE(object):
 
-    UUID_REGEX = r'^[a-f0-9]{8}-([a-f0-9]{4}-){3}[a-f0-9]{12}$'
+    UUID_RE = re.compile(r'^[a-f0-9]{8}-([a-f0-9]{4}-){3}[a-f0-9]{12}$')
+
+    # `zpool list` followed by an imgadm command in a single shell
+    PROBE_SCRIPT = '"$1" list "$2" >/dev/null 2>&1 || exit %d; shift 2; exec "$@"'
+    PROBE_NO_ZPOOL = 100
 
-    def __init__(self, module):
+    def __init__(self, module, uuid, bin_paths):
         self.module = module
 
-        self.uuid     = module.params['uuid']
+        self.uuid     = uuid
         self.state    = module.params['state']
         self.zpool    = module.params['zpool']
         self.update   = module.params['update']
-        self.manifest = 'init'
+        self.manifest = None
 
-    def is_local(self):
-        cmd = [self.module.get_bin_path('imgadm', True)]
-        cmd.append('info')
-        if self.zpool:
-            cmd.append('-P')
-            cmd.append(self.zpool)
-        cmd.append(self.uuid)
+        # resolved once in main() and shared by all images of a run
+        self._imgadm  = bin_paths['imgadm']
+        self._zpool   = bin_paths['zpool']
+        self._sh      = bin_paths['sh']
 
-        (rc, info, _) = self.module.run_command(cmd)
+        # results of `zpool list` and of the existence check, None if unknown
+        self._zpool_ok     = None
+        self._exists_cache = None
 
-        if rc == 0:
-            self.manifest = json.loads(info)['manifest']
-            return True
-        else:
+    def _pool_args(self):
+        return ['-P', self.zpool] if self.zpool else []
+
+    def probe(self):
+        cmd = [self._sh, '-c', self.PROBE_SCRIPT % self.PROBE_NO_ZPOOL, 'sh',
+               self._zpool, self.zpool] + self._list_cmd()
+
+        (rc, out, _) = self.module.run_command(cmd)
+
+        self._zpool_ok = (rc != self.PROBE_NO_ZPOOL)
+        if not self._zpool_ok:
             return False
 
+        self._store_list(rc, out)
+
+        return True
+
+    def _list_cmd(self):
+        # `imgadm list` does not read the whole manifest like `imgadm info`
+        return [self._imgadm, 'list', '-H', '-o', 'uuid,zpool', 'uuid=%s' % self.uuid]
+
+    def _store_list(self, rc, out):
+        # `imgadm list` has no -P, the zpool is matched on its output
+        self._exists_cache = False
+        if rc == 0:
+            for line in out.splitlines():
+                fields = line.split()
+                if fields and fields[0] == self.uuid and \
+                        (not self.zpool or fields[1:] == [self.zpool]):
+                    self._exists_cache = True
+
+    def _forget(self):
+        self._exists_cache = None
+        self.manifest      = None
+
+    def exists(self):
+        if self._exists_cache is None:
+            (rc, out, _) = self.module.run_command(self._list_cmd())
+
+            self._store_list(rc, out)
+
+        return self._exists_cache
+
+    def load_manifest(self):
+        if self.manifest is None and self._exists_cache is not False:
+            cmd = [self._imgadm, 'info'] + self._pool_args() + [self.uuid]
+
+            (rc, info, _) = self.module.run_command(cmd)
+
+            self._exists_cache = (rc == 0)
+            if rc == 0:
+                self.manifest = json.loads(info)['manifest']
+
+        return self.manifest
 
     def zpool_exists(self):
-        cmd = [self.module.get_bin_path('zpool', True)]
-        cmd.append('list')
-        cmd.append(self.zpool)
+        if self._zpool_ok is not None:
+            return self._zpool_ok
+
+        cmd = [self._zpool, 'list', self.zpool]
 
         (rc, _, _) = self.module.run_command(cmd)
 
-        return rc == 0
+        self._zpool_ok = (rc == 0)
+
+        return self._zpool_ok
 
     def has_valid_uuid(self):
-        uuid_re = re.match(self.UUID_REGEX, self.uuid)
+        return IMAGE.UUID_RE.match(self.uuid) is not None
+
+    def import_cmd(self):
+        return [self._imgadm, 'import'] + self._pool_args() + [self.uuid]
 
-        return uuid_re is not None
+    def import_image(self, imported=None):
+        # imported is the result of an import done by import_images()
+        (rc, out, err) = imported or self.module.run_command(self.import_cmd())
 
-    def import_image(self):
-        cmd = [self.module.get_bin_path('imgadm', True)]
-        cmd.append('import')
-        if self.zpool:
-            cmd.append('-P')
-            cmd.append(self.zpool)
-        cmd.append(self.uuid)
+        # image is local now, but its manifest has to be read again
+        self._forget()
 
-        return self.module.run_command(cmd)
+        return (rc, out, err)
 
     def delete(self):
-        cmd = [self.module.get_bin_path('imgadm', True)]
-        cmd.append('delete')
-        if self.zpool:
-            cmd.append('-P')
-            cmd.append(self.zpool)
-        cmd.append(self.uuid)
+        cmd = [self._imgadm, 'delete'] + self._pool_args() + [self.uuid]
 
-        return self.module.run_command(cmd)
+        (rc, out, err) = self.module.run_command(cmd)
 
-    def update(self):
-        cmd = [self.module.get_bin_path('imgadm', True)]
-        cmd.append('update')
-        cmd.append(self.uuid)
+        self._forget()
+        if rc == 0:
+            self._exists_cache = False
 
-        return self.module.run_command(cmd)
+        return (rc, out, err)
 
+    def update_image(self):
+        cmd = [self._imgadm, 'update', self.uuid]
 
+        (rc, out, err) = self.module.run_command(cmd)
 
+        # an update may change the manifest
+        self._forget()
 
+        return (rc, out, err)
 
 
-def main():
-    module = AnsibleModule(
-        argument_spec=dict(
-            uuid   = dict(required = True),
-            state  = dict(default = 'present', choices = ['present', 'absent']),
-            zpool  = dict(default = 'zones'),
-            update = dict(default = False, type = 'bool')
-        ),
-        supports_check_mode = True
-    )
 
-    image = IMAGE(module)
 
-    result  = {'changed': False} # set to True if changes happen
-    out     = ''
-    err     = ''
 
 
-# check if uuid is valid
-# ---------------------------------------------------------
-    if not image.has_valid_uuid():
-        module.fail_json(
-            msg = 'Invalid image UUID.', 
-            uuid = image.uuid, 
-            zpool = image.zpool)
+def import_images(module, images, concurrency):
+    # run_command() changes os.environ while it runs and must not be used
+    # from threads, so the import children are started and reaped here.
+    # This bypasses the logging and no_log handling of run_command(), so
+    # keep it to the `imgadm import` argv, which holds no secrets.
+    env = dict(os.environ)
+    env.update(module.run_command_environ_update)
 
-# check if zpool exists
-# ---------------------------------------------------------
-    if not image.zpool_exists():
-        module.fail_json(
-            msg = 'zpool is not available.', 
-            uuid = image.uuid, 
-            zpool = image.zpool)
+    imported = [None] * len(images)
+    pending  = list(enumerate(images))
+    running  = []
+
+    while pending or running:
+        while pending and len(running) < concurrency:
+            (i, image) = pending.pop(0)
+            out = tempfile.TemporaryFile()
+            err = tempfile.TemporaryFile()
+            try:
+                proc = subprocess.Popen(image.import_cmd(), stdout = out,
+                                        stderr = err, env = env, close_fds = True)
+            except OSError as e:
+                out.close()
+                err.close()
+                imported[i] = (e.errno, '', to_native(e))
+                continue
+            running.append((i, proc, out, err))
+
+        # reap whichever children are done, so one slow download does not
+        # keep the free slots from being refilled
+        done = [entry for entry in running if entry[1].poll() is not None]
+        if running and not done:
+            time.sleep(0.1)
+
+        for entry in done:
+            running.remove(entry)
+            (i, proc, out, err) = entry
+            out.seek(0)
+            err.seek(0)
+            imported[i] = (proc.returncode, to_native(out.read()), to_native(err.read()))
+            out.close()
+            err.close()
+
+    return imported
+
+
+def manage_image(module, image, imported=None):
+    result  = {'changed': False} # set to True if changes happen
+    out     = ''
+    err     = ''
 
 # state: present
 # ---------------------------------------------------------
     if image.state == 'present':
 
         if module.check_mode:
-            if image.is_local():
+            if image.load_manifest() is not None:
+                result['manifest'] = image.manifest
                 out = 'Image %s (%s) is already installed, skipping.' % (image.uuid, image.manifest['name'])
             else:
                 result['changed'] = True
-                result['manifest'] = json.loads('{ "faked": "True", "reason": "check_mode" }')
+                result['manifest'] = {'faked': True, 'reason': 'check_mode'}
                 out = 'have to download image'
         else:
-            (rc, out, err) = image.import_image()
+            (rc, out, err) = image.import_image(imported)
             if rc != 0:
-                module.fail_json(
-                    msg = 'Error importing image!', 
-                    uuid = image.uuid, 
-                    zpool = image.zpool, 
-                    rc = rc, 
-                    stderr = str(err), 
-                    stdout = str(out))
-            if image.update:
-                (rc, out, err) = image.update() 
-                if rc != 0:
-                    module.fail_json(
-                        msg = 'Error updating image!', 
-                        uuid = image.uuid, 
-                        zpool = image.zpool, 
-                        rc = rc, 
-                        stderr = str(err), 
-                        stdout = str(out))
+                result.update(failed = True, msg = 'Error importing image!', rc = rc)
+            else:
+                if image.update:
+                    (rc, out, err) = image.update_image()
+                    if rc != 0:
+                        result.update(failed = True, msg = 'Error updating image!', rc = rc)
+                # read again after import or update
+                if image.load_manifest() is not None:
+                    result['manifest'] = image.manifest
            
 # state: absent
 # ---------------------------------------------------------
     if image.state == 'absent':
 
-        if image.is_local():
-            result['changed'] = True
-            if not module.check_mode:
+        if image.exists():
+            if module.check_mode:
+                result['changed'] = True
+                if image.load_manifest() is not None:
+                    result['manifest'] = image.manifest
+            else:
                 (rc, out, err) = image.delete()
                 if rc != 0:
-                    module.fail_json(
-                        msg = 'Error deleting image!', 
-                        uuid = image.uuid, 
-                        zpool = image.zpool, 
-                        rc = rc, 
-                        stderr = str(err), 
-                        stdout = str(out))
+                    result.update(failed = True, msg = 'Error deleting image!', rc = rc)
+                else:
+                    result['changed'] = True
         else:
             out = 'Image "%s" was not found on zpool "%s".' % (image.uuid, image.zpool)
 
 # ---------------------------------------------------------
-    result['stdout']   = str(out)
-    result['stderr']   = str(err)
+    result['stdout']   = out
+    result['stderr']   = err
     result['uuid']     = image.uuid
     result['state']    = image.state
     result['zpool']    = image.zpool
-    if image.is_local():
-        result['manifest'] = image.manifest
-        
+
+    return result
+
+
+def main():
+    module = AnsibleModule(
+        argument_spec=dict(
+            uuid   = dict(required = True, type = 'list'),
+            state  = dict(default = 'present', choices = ['present', 'absent']),
+            zpool  = dict(default = 'zones'),
+            update = dict(default = False, type = 'bool'),
+            concurrency = dict(default = 3, type = 'int')
+        ),
+        supports_check_mode = True
+    )
+
+    bin_paths = dict((name, module.get_bin_path(name, True))
+                     for name in ('imgadm', 'zpool', 'sh'))
+    images = [IMAGE(module, uuid, bin_paths) for uuid in module.params['uuid']]
+    concurrency = module.params['concurrency']
+
+    if concurrency < 1:
+        module.fail_json(
+            msg = 'concurrency has to be at least 1.', 
+            concurrency = concurrency)
+
+
+# check if uuids are valid
+# ---------------------------------------------------------
+    for image in images:
+        if not image.has_valid_uuid():
+            module.fail_json(
+                msg = 'Invalid image UUID.', 
+                uuid = image.uuid, 
+                zpool = image.zpool)
+
+# check once if zpool exists, together with the first image if that is
+# needed before changing anything
+# ---------------------------------------------------------
+    if module.check_mode or images[0].state == 'absent':
+        zpool_ok = images[0].probe()
+    else:
+        zpool_ok = images[0].zpool_exists()
+
+    if not zpool_ok:
+        module.fail_json(
+            msg = 'zpool is not available.', 
+            uuid = module.params['uuid'], 
+            zpool = images[0].zpool)
+
+# import several images in parallel, errors are handled afterwards
+# ---------------------------------------------------------
+    imported = [None] * len(images)
+    if (images[0].state == 'present' and not module.check_mode
+            and len(images) > 1 and concurrency > 1):
+        imported = import_images(module, images, concurrency)
+
+# ---------------------------------------------------------
+    results = [manage_image(module, image, rce)
+               for (image, rce) in zip(images, imported)]
+
+    if len(results) == 1:
+        result = dict(results[0])
+    else:
+        result = {
+            'changed': any(r['changed'] for r in results),
+            'state':   images[0].state,
+            'zpool':   images[0].zpool,
+        }
+    result['results'] = results
+
+# report all failed images at once, the others may have been changed
+# ---------------------------------------------------------
+    failed = [r['uuid'] for r in results if r.get('failed')]
+    if failed:
+        if len(results) > 1:
+            result['msg'] = 'Error managing images %s!' % ', '.join(failed)
+        module.fail_json(**result)
 
     module.exit_json(**result)
 
-from ansible.module_utils.basic import AnsibleModule
 if __name__ == '__main__':
     main()
 
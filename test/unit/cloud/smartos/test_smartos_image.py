@@ -0,0 +1,289 @@
+# -*- coding: utf-8 -*-
+
+# Unit tests for the smartos_image module.
+#
+# These tests are not run by the shippable jobs. Run them by hand from the
+# repository root with ansible importable:
+#
+#   PYTHONPATH=. python -m unittest discover -s test/unit/cloud/smartos
+#
+# This code is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+
+import json
+import os
+import unittest
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+from cloud.smartos import smartos_image
+
+
+UUID_A = 'd183f500-9a96-11e6-8976-ff3967dc023a'
+UUID_B = '390639d4-f146-11e7-9280-37ae5c6d53d4'
+UUID_C = 'e75c9d82-3156-11e5-9f7a-0b2b5c6bd5a0'
+
+
+class AnsibleExitJson(Exception):
+    pass
+
+
+class AnsibleFailJson(Exception):
+    pass
+
+
+class FakeHost(object):
+    """Answers the imgadm and zpool commands of a SmartOS host."""
+
+    def __init__(self, zpools=('zones',), images=(), failing=(), slow=None):
+        self.zpools = set(zpools)
+        self.images = set(images)
+        self.failing = set(failing)
+        # uuid -> uuids whose imports have to finish before its own does
+        self.slow = slow or {}
+        self.commands = []
+        self.finished = []
+
+    def run_command(self, cmd):
+        self.commands.append(cmd)
+
+        return self.answer(cmd)
+
+    def answer(self, cmd):
+        name = os.path.basename(cmd[0])
+
+        if name == 'sh':
+            # probe: sh -c <script> sh <zpool> <pool> <imgadm command ...>
+            if cmd[5] not in self.zpools:
+                return (smartos_image.IMAGE.PROBE_NO_ZPOOL, '', '')
+            return self.answer(cmd[6:])
+
+        if name == 'zpool':
+            return (0 if cmd[2] in self.zpools else 1, '', '')
+
+        verb = cmd[1]
+        uuid = cmd[-1].split('=')[-1]
+
+        if verb == 'list':
+            return (0, '%s  zones\n' % uuid if uuid in self.images else '', '')
+        if verb == 'info':
+            if uuid not in self.images:
+                return (3, '', 'image not installed')
+            return (0, json.dumps({'manifest': {'uuid': uuid, 'name': 'image'}}), '')
+        if uuid in self.failing:
+            return (1, '', '%s of %s failed' % (verb, uuid))
+        if verb == 'import':
+            self.images.add(uuid)
+            return (0, 'Imported image %s' % uuid, '')
+        if verb == 'delete':
+            self.images.discard(uuid)
+            return (0, 'Deleted image %s' % uuid, '')
+        if verb == 'update':
+            return (0, 'Updated image %s' % uuid, '')
+
+        raise AssertionError('unexpected command %r' % (cmd,))
+
+    def verbs(self):
+        return [os.path.basename(c[0]) + ' ' + c[1] for c in self.commands]
+
+    def popen(self, cmd, stdout, stderr, **kwargs):
+        host = self
+        host.commands.append(cmd)
+        (rc, out, err) = host.answer(cmd)
+        stdout.write(out.encode('utf-8'))
+        stderr.write(err.encode('utf-8'))
+        uuid = cmd[-1]
+
+        class Process(object):
+            returncode = None
+
+            def poll(self):
+                if self.returncode is None:
+                    if not set(host.slow.get(uuid, ())) <= set(host.finished):
+                        return None
+                    self.returncode = rc
+                    host.finished.append(uuid)
+                return self.returncode
+
+            def wait(self):
+                if self.poll() is None:
+                    raise AssertionError('wait() for %s would block' % uuid)
+                return self.returncode
+
+        return Process()
+
+
+class FakeModule(object):
+
+    def __init__(self, host, check_mode=False, **params):
+        self.params = {
+            'uuid': [UUID_A],
+            'state': 'present',
+            'zpool': 'zones',
+            'update': False,
+            'concurrency': 3,
+        }
+        self.params.update(params)
+        self.check_mode = check_mode
+        self.run_command = mock.Mock(side_effect=host.run_command)
+        self.run_command_environ_update = {}
+
+    def get_bin_path(self, name, required=False):
+        return '/usr/sbin/%s' % name
+
+    def exit_json(self, **kwargs):
+        # results are serialized the same way by the real module
+        json.dumps(kwargs)
+        raise AnsibleExitJson(kwargs)
+
+    def fail_json(self, **kwargs):
+        json.dumps(kwargs)
+        raise AnsibleFailJson(kwargs)
+
+
+class TestSmartosImage(unittest.TestCase):
+
+    def run_module(self, host, check_mode=False, **params):
+        self.module = FakeModule(host, check_mode=check_mode, **params)
+        with mock.patch.object(smartos_image, 'AnsibleModule', return_value=self.module):
+            with mock.patch.object(smartos_image.subprocess, 'Popen', side_effect=host.popen) as popen, \
+                    mock.patch.object(smartos_image.time, 'sleep'):
+                self.popen = popen
+                try:
+                    smartos_image.main()
+                except AnsibleExitJson as e:
+                    return e.args[0]
+                except AnsibleFailJson as e:
+                    result = e.args[0]
+                    result['failed'] = True
+                    return result
+        self.fail('module did not exit')
+
+    def test_single_uuid(self):
+        host = FakeHost()
+        result = self.run_module(host)
+
+        self.assertEqual(result['uuid'], UUID_A)
+        self.assertEqual(result['manifest']['uuid'], UUID_A)
+        self.assertEqual(len(result['results']), 1)
+        self.assertNotIn('results', result['results'][0])
+        self.assertIn(UUID_A, host.images)
+        self.assertEqual(host.verbs(), ['zpool list', 'imgadm import', 'imgadm info'])
+
+    def test_update(self):
+        host = FakeHost()
+        result = self.run_module(host, update=True)
+
+        self.assertNotIn('failed', result)
+        self.assertEqual(result['stdout'], 'Updated image %s' % UUID_A)
+        self.assertEqual(result['manifest']['uuid'], UUID_A)
+        # the manifest is read again after the update
+        self.assertEqual(host.verbs(), ['zpool list', 'imgadm import',
+                                        'imgadm update', 'imgadm info'])
+
+    def test_several_uuids_parallel(self):
+        host = FakeHost()
+        result = self.run_module(host, uuid=[UUID_A, UUID_B])
+
+        self.assertNotIn('failed', result)
+        self.assertEqual([r['uuid'] for r in result['results']], [UUID_A, UUID_B])
+        self.assertEqual(host.images, set([UUID_A, UUID_B]))
+        # imports are started by Popen, not by run_command
+        self.assertEqual(self.popen.call_count, 2)
+        for call in self.module.run_command.call_args_list:
+            self.assertNotEqual(call[0][0][1], 'import')
+
+    def test_several_uuids_slow_import_does_not_block(self):
+        host = FakeHost(slow={UUID_A: [UUID_B, UUID_C]})
+        result = self.run_module(host, uuid=[UUID_A, UUID_B, UUID_C], concurrency=2)
+
+        self.assertNotIn('failed', result)
+        self.assertEqual([r['uuid'] for r in result['results']], [UUID_A, UUID_B, UUID_C])
+        # the slot of UUID_B is reused for UUID_C while UUID_A still runs
+        self.assertEqual(self.popen.call_count, 3)
+        self.assertEqual(host.finished, [UUID_B, UUID_C, UUID_A])
+
+    def test_several_uuids_sequential(self):
+        host = FakeHost()
+        result = self.run_module(host, uuid=[UUID_A, UUID_B], concurrency=1)
+
+        self.assertNotIn('failed', result)
+        self.assertEqual(host.images, set([UUID_A, UUID_B]))
+        self.assertEqual(self.popen.call_count, 0)
+        self.assertEqual(host.verbs(), ['zpool list',
+                                        'imgadm import', 'imgadm info',
+                                        'imgadm import', 'imgadm info'])
+
+    def test_several_uuids_failures_are_collected(self):
+        host = FakeHost(failing=[UUID_A])
+        result = self.run_module(host, uuid=[UUID_A, UUID_B])
+
+        self.assertTrue(result['failed'])
+        self.assertIn(UUID_A, result['msg'])
+        self.assertTrue(result['results'][0]['failed'])
+        self.assertNotIn('failed', result['results'][1])
+        self.assertIn(UUID_B, host.images)
+
+    def test_check_mode_present_local(self):
+        host = FakeHost(images=[UUID_A])
+        result = self.run_module(host, check_mode=True)
+
+        self.assertFalse(result['changed'])
+        self.assertEqual(result['manifest'], {'uuid': UUID_A, 'name': 'image'})
+        self.assertIn('already installed', result['stdout'])
+        self.assertEqual(host.verbs(), ['sh -c', 'imgadm info'])
+
+    def test_check_mode_present_missing(self):
+        host = FakeHost()
+        result = self.run_module(host, check_mode=True)
+
+        self.assertTrue(result['changed'])
+        self.assertEqual(result['manifest'], {'faked': True, 'reason': 'check_mode'})
+        self.assertEqual(host.images, set())
+        self.assertEqual(host.verbs(), ['sh -c'])
+
+    def test_check_mode_absent_local(self):
+        host = FakeHost(images=[UUID_A])
+        result = self.run_module(host, check_mode=True, state='absent')
+
+        self.assertTrue(result['changed'])
+        self.assertEqual(result['manifest'], {'uuid': UUID_A, 'name': 'image'})
+        self.assertEqual(host.images, set([UUID_A]))
+        self.assertEqual(host.verbs(), ['sh -c', 'imgadm info'])
+
+    def test_absent_uses_imgadm_list(self):
+        host = FakeHost(images=[UUID_A])
+        result = self.run_module(host, uuid=[UUID_A, UUID_B], state='absent')
+
+        self.assertTrue(result['changed'])
+        self.assertEqual(host.images, set())
+        self.assertEqual(host.verbs(), ['sh -c', 'imgadm delete', 'imgadm list'])
+        # the probe checks the first image with `imgadm list` as well
+        self.assertEqual(host.commands[0][7], 'list')
+        for call in self.module.run_command.call_args_list:
+            self.assertNotIn('info', call[0][0])
+
+    def test_missing_zpool(self):
+        host = FakeHost(zpools=[])
+        result = self.run_module(host, state='absent')
+
+        self.assertTrue(result['failed'])
+        self.assertEqual(result['msg'], 'zpool is not available.')
+        self.assertEqual(host.verbs(), ['sh -c'])
+
+    def test_concurrency_below_one(self):
+        host = FakeHost()
+        result = self.run_module(host, uuid=[UUID_A, UUID_B], concurrency=0)
+
+        self.assertTrue(result['failed'])
+        self.assertEqual(result['msg'], 'concurrency has to be at least 1.')
+        self.assertEqual(host.commands, [])
+
+
+if __name__ == '__main__':
+    unittest.main()